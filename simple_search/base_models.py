@@ -1,25 +1,93 @@
 # -*- encoding: utf-8 -*-
 
+import itertools
 import logging
 import re
-import time
+from collections import defaultdict
 
 import nltk
+from django.core.cache import cache
 from django.db import models
+from django.utils import timezone
 from django.utils.encoding import smart_unicode
 from google.appengine.ext import db
 from google.appengine.ext.deferred import defer
 from django.conf import settings
 
+from instrumentation import index_completed, incr, operation, phase, set_count
+from transactions import retry_transaction
+
 QUEUE_FOR_INDEXING = getattr(settings, "QUEUE_FOR_INDEXING", "default")
 
+# Seconds to wait before applying GlobalOccuranceCount changes which kept colliding
+COUNT_RECONCILE_DELAY = getattr(settings, "SEARCH_COUNT_RECONCILE_DELAY", 10)
+
+# With INLINE_COUNTS GlobalOccuranceCounts are updated as terms are indexed and unindexed. With LOG_COUNTS
+# indexing only appends GlobalOccuranceDeltas, which fold_count_deltas later applies in batches.
+INLINE_COUNTS = "inline"
+LOG_COUNTS = "log"
+SEARCH_COUNT_MODE = getattr(settings, "SEARCH_COUNT_MODE", INLINE_COUNTS)
+COUNT_BATCH_SIZE = getattr(settings, "SEARCH_COUNT_BATCH_SIZE", 500)
+
+# GlobalOccuranceCounts of a CompactIndex are keyed "#<term id>", which sort between these two keys.
+# Every other key belongs to an index of per term records.
+COMPACT_COUNT_KEY_RANGE = ("#0", "#:")
+
+# The most GlobalOccuranceDeltas that can be deleted in the same cross group transaction as their count
+MAX_DELTAS_PER_TRANSACTION = 24
+
+# While a chain of fold_count_deltas tasks is running it holds this cache key, so only one chain runs at a time.
+# The lease is renewed with every batch, and expires after SEARCH_COUNT_FOLD_LEASE seconds if a chain dies.
+FOLD_LEASE_KEY = "simple_search_fold_count_deltas"
+FOLD_LEASE_TIMEOUT = getattr(settings, "SEARCH_COUNT_FOLD_LEASE", 60 * 10)
+
+NLTK_TOKENIZER = "nltk"
+REGEX_TOKENIZER = "regex"
+SEARCH_TOKENIZER = getattr(settings, "SEARCH_TOKENIZER", NLTK_TOKENIZER)
+
+# The regex tokenizer mimics the parts of nltk's Treebank tokenizer that survive normalize():
+# brackets and symbols become separate tokens, contractions are split off ("isn't" -> "is", "n't"),
+# and double quotes are dropped rather than being turned into `` and '' tokens.
+_SYMBOLS_RE = re.compile(ur'[;@#$%&?!\[\](){}<>]', re.UNICODE)
+_CONTRACTIONS_RE = re.compile(ur"(?<=[^'\s])(n't|'(?:s|m|d|ll|re|ve)?)(?=\s|$)", re.UNICODE)
+_SPLIT_WORDS_RE = re.compile(ur"\b(can(?=not\b)|gim(?=me\b)|gon(?=na\b)|got(?=ta\b)|lem(?=me\b)|wan(?=na\b))", re.UNICODE)
+
+
+# How terms are built from adjacent words. Override these for a model with an ngrams dict on its Search class,
+# and for a single field with a dict in Search.field_ngrams, e.g. field_ngrams = {"body": {"max_length": 2}}
+DEFAULT_NGRAM_POLICY = {
+    # The most adjacent words indexed together as one term. Quoted phrases longer than this are searched as
+    # overlapping phrases of this length.
+    "max_length": 4,
+    # Don't index adjacent words as a term if they're separated by punctuation, e.g. "apples, bananas"
+    "phrase_boundaries": False,
+    # Words too common to be worth indexing terms made up only of them, e.g. ["new", "york"].
+    "common_terms": (),
+    # Words with a GlobalOccuranceCount of at least this many are treated as common_terms too, going by a
+    # snapshot of the counts taken every SEARCH_COMMON_WORDS_TIMEOUT seconds
+    "common_threshold": None,
+}
+
+COMMON_WORDS_TIMEOUT = getattr(settings, "SEARCH_COMMON_WORDS_TIMEOUT", 60 * 60)
+
+_PHRASE_BOUNDARIES_RE = re.compile(ur'[,.;:!?]+(?=\s|$)|[()\[\]{}<>"|–—]', re.UNICODE)
+
+
+def regex_tokenize(text):
+    """ A fast alternative to nltk.word_tokenize for text that has already been normalized. """
+    text = _SYMBOLS_RE.sub(u" \\g<0> ", text)
+    text = text.replace(u'"', u" ")
+    text = _CONTRACTIONS_RE.sub(u" \\1", text)
+    text = _SPLIT_WORDS_RE.sub(u"\\1 ", text)
+    return text.split()
+
 
 class GlobalOccuranceCount(models.Model):
     id = models.CharField(max_length=1024, primary_key=True)
     count = models.PositiveIntegerField(default=0)
 
     def update(self, index_class):
-        count = sum(index_class.objects.filter(iexact=self.id).values_list('occurances', flat=True))
+        count = index_class.count_occurances(self.id)
 
         @db.transactional
         def txn():
@@ -27,13 +95,178 @@ class GlobalOccuranceCount(models.Model):
             goc.count = count
             goc.save()
 
-        while True:
+        try:
+            retry_transaction(txn)
+        except db.TransactionFailedError:
+            logging.warning("Couldn't update GlobalOccuranceCount %s, deferring", self.id)
+            defer(self.update, index_class, _queue=QUEUE_FOR_INDEXING, _countdown=COUNT_RECONCILE_DELAY)
+
+
+class GlobalOccuranceDelta(models.Model):
+    """ A pending change to a GlobalOccuranceCount, written instead of the count itself in LOG_COUNTS mode. """
+    term = models.CharField(max_length=1024)
+    delta = models.IntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+
+@db.transactional
+def _apply_count_delta(term, delta):
+    try:
+        counter = GlobalOccuranceCount.objects.get(pk=term)
+    except GlobalOccuranceCount.DoesNotExist:
+        counter = GlobalOccuranceCount(pk=term)
+
+    if counter.count + delta > 0:
+        counter.count += delta
+        counter.save()
+    elif not counter._state.adding:
+        counter.delete()
+
+
+def apply_count_deltas(deltas):
+    """ Add a dict of {term: delta} to the GlobalOccuranceCounts, deleting any that drop to zero.
+        Deltas which still can't be applied are deferred again.
+    """
+    failed_deltas = {}
+    for term, delta in deltas.items():
+        change_count(term, delta, failed_deltas)
+
+    if failed_deltas:
+        defer_count_deltas(failed_deltas)
+
+
+def defer_count_deltas(deltas):
+    """ Apply a dict of {term: delta} to the GlobalOccuranceCounts in a background task. """
+    logging.warning("Deferring %s GlobalOccuranceCount changes after transaction collisions", len(deltas))
+    incr("deferred_count_deltas", len(deltas))
+    defer(apply_count_deltas, deltas, _queue=QUEUE_FOR_INDEXING, _countdown=COUNT_RECONCILE_DELAY)
+
+
+def log_count_deltas(deltas):
+    """ Append a dict of {term: delta} to the GlobalOccuranceDelta log. """
+    GlobalOccuranceDelta.objects.bulk_create([
+        GlobalOccuranceDelta(term=term, delta=delta) for term, delta in deltas.items() if delta
+    ])
+
+
+@db.transactional(xg=True)
+def _fold_deltas(term, delta_pks):
+    # The query which found these deltas is eventually consistent and can still return ones which were
+    # already folded and deleted, so get them again by key and only apply the ones which still exist
+    deltas = list(GlobalOccuranceDelta.objects.filter(pk__in=delta_pks))
+    if not deltas:
+        return
+
+    _apply_count_delta(term, sum(x.delta for x in deltas))
+    for delta in deltas:
+        delta.delete()
+
+
+def get_common_count_keys(threshold):
+    """ The keys of every GlobalOccuranceCount of at least threshold. This is cached for
+        SEARCH_COMMON_WORDS_TIMEOUT seconds, so indexing and searching go by the same snapshot of the counts
+        rather than reading them every time.
+    """
+    cache_key = "simple_search_common_words:%s" % threshold
+    common_keys = cache.get(cache_key)
+    if common_keys is None:
+        common_keys = frozenset(GlobalOccuranceCount.objects.filter(count__gte=threshold).values_list('pk', flat=True))
+        cache.set(cache_key, common_keys, COMMON_WORDS_TIMEOUT)
+    return common_keys
+
+
+def start_fold_count_deltas(batch_size=COUNT_BATCH_SIZE):
+    """ Defer fold_count_deltas, unless a chain of them is already running. Returns whether it was deferred. """
+    if not cache.add(FOLD_LEASE_KEY, True, FOLD_LEASE_TIMEOUT):
+        return False
+
+    defer(fold_count_deltas, batch_size, _queue=QUEUE_FOR_INDEXING)
+    return True
+
+
+def fold_count_deltas(batch_size=COUNT_BATCH_SIZE):
+    """ Apply the oldest batch_size logged deltas to the GlobalOccuranceCounts, then defer the next batch.
+
+        Each count is updated in the same transaction that deletes the deltas it applied, and deltas are read
+        again by key inside that transaction, so this can be stopped and rerun at any point without counting
+        anything twice. Deltas which keep colliding are left for the next run, and if none of a batch could be
+        folded the chain stops rather than rereading the same deltas, so the next cron run picks them up.
+
+        Start it with start_fold_count_deltas, which makes sure only one chain of batches runs at a time.
+    """
+    deltas = list(GlobalOccuranceDelta.objects.order_by("created")[:batch_size])
+
+    deltas_by_term = defaultdict(list)
+    for delta in deltas:
+        deltas_by_term[delta.term].append(delta)
+
+    folded = 0
+    for term, term_deltas in deltas_by_term.items():
+        for i in xrange(0, len(term_deltas), MAX_DELTAS_PER_TRANSACTION):
+            chunk = term_deltas[i:i + MAX_DELTAS_PER_TRANSACTION]
             try:
-                txn()
-                break
+                retry_transaction(_fold_deltas, term, [x.pk for x in chunk])
             except db.TransactionFailedError:
-                time.sleep(1)
-                continue
+                logging.warning("Couldn't fold GlobalOccuranceDeltas for %s, leaving them for the next run", term)
+            else:
+                folded += len(chunk)
+
+    logging.info("[SIMPLE_SEARCH] Folded %s of %s GlobalOccuranceDeltas for %s terms",
+                 folded, len(deltas), len(deltas_by_term))
+
+    if len(deltas) == batch_size and folded:
+        cache.set(FOLD_LEASE_KEY, True, FOLD_LEASE_TIMEOUT)
+        defer(fold_count_deltas, batch_size, _queue=QUEUE_FOR_INDEXING)
+    else:
+        cache.delete(FOLD_LEASE_KEY)
+
+
+def recompute_global_counts(index_class, batch_size=COUNT_BATCH_SIZE, last_term=None):
+    """ Recompute every GlobalOccuranceCount kept for index_class (those in its count_key_ranges) from its index
+        records, deferring itself to carry on from last_term after each batch.
+
+        Logged deltas created before a count was recomputed are already reflected in it, so they are deleted.
+        If this is interrupted between the two, running it again corrects the count.
+    """
+    counters = []
+    for low, high in index_class.count_key_ranges():
+        if last_term is not None and high is not None and last_term >= high:
+            continue
+
+        query = GlobalOccuranceCount.objects.order_by("pk")
+        if last_term is not None and (low is None or last_term >= low):
+            query = query.filter(pk__gt=last_term)
+        elif low is not None:
+            query = query.filter(pk__gte=low)
+        if high is not None:
+            query = query.filter(pk__lt=high)
+
+        counters.extend(query[:batch_size - len(counters)])
+        if len(counters) == batch_size:
+            break
+
+    for counter in counters:
+        started = timezone.now()
+        counter.update(index_class)
+        GlobalOccuranceDelta.objects.filter(term=counter.pk, created__lte=started).delete()
+
+    logging.info("[SIMPLE_SEARCH] Recomputed %s GlobalOccuranceCounts", len(counters))
+
+    if len(counters) == batch_size:
+        defer(recompute_global_counts, index_class, batch_size, counters[-1].pk, _queue=QUEUE_FOR_INDEXING)
+
+
+def change_count(term, delta, failed_deltas=None):
+    """ Add delta to the GlobalOccuranceCount for term. If the transaction keeps colliding the delta is
+        added to failed_deltas when given, so the caller can defer a batch of them, or deferred straight away.
+    """
+    try:
+        retry_transaction(_apply_count_delta, term, delta)
+    except db.TransactionFailedError:
+        if failed_deltas is None:
+            defer_count_deltas({term: delta})
+        else:
+            failed_deltas[term] = failed_deltas.get(term, 0) + delta
 
 
 class AbstractIndexRecord(models.Model):
@@ -55,8 +288,29 @@ class AbstractIndexRecord(models.Model):
     # or any kind of resource identifier.
     OBJECT_ID_FIELD = ''
 
-    def delete(self):
+    @classmethod
+    def count_occurances(cls, term):
+        """ Total occurances of the term across all records, used to recompute its GlobalOccuranceCount. """
+        return sum(cls.objects.filter(iexact=term).values_list('occurances', flat=True))
+
+    @classmethod
+    def count_key_ranges(cls):
+        """ The (low, high) ranges of GlobalOccuranceCount keys counting these records, high being exclusive
+            and None meaning unbounded.
+        """
+        low, high = COMPACT_COUNT_KEY_RANGE
+        return [(None, low), (high, None)]
+
+    def delete(self, using=None):
         """ Remove a single index record. """
+        self._delete_with_count(using=using)
+
+    def _delete_with_count(self, failed_deltas=None, using=None):
+        """ Delete the record and subtract it from its GlobalOccuranceCount.
+
+            If the GlobalOccuranceCount can't be updated the record is deleted anyway and the count change is
+            deferred, or added to failed_deltas when given.
+        """
 
         @db.transactional(xg=True)
         def txn(record):
@@ -66,27 +320,39 @@ class AbstractIndexRecord(models.Model):
             else:
                 count.count -= record.occurances
                 count.save()
-            super(AbstractIndexRecord, record).delete()
+            super(AbstractIndexRecord, record).delete(using=using)
 
         try:
-            while True:
-                try:
-                    txn(self)
-                    break
-                except db.TransactionFailedError:
-                    logging.warning("Transaction collision, retrying!")
-                    time.sleep(1)
-                    continue
+            retry_transaction(txn, self)
+        except db.TransactionFailedError:
+            self.delete_record(using=using)
+            if failed_deltas is None:
+                defer_count_deltas({self.iexact: -self.occurances})
+            else:
+                failed_deltas[self.iexact] = failed_deltas.get(self.iexact, 0) - self.occurances
         except GlobalOccuranceCount.DoesNotExist:
             logging.warning(
                 "A GlobalOccuranceCount for Index: %s "
                 "does not exist, ignoring", self.pk
             )
 
+    def delete_record(self, using=None):
+        """ Delete the record without touching its GlobalOccuranceCount. """
+        super(AbstractIndexRecord, self).delete(using=using)
+
 
-class AbstractIndex(object):
+class BaseIndex(object):
+    """ The indexing, n-gram, counting and ranking machinery shared by every index. Subclasses decide how
+        index records are stored and matched, see AbstractIndex for indexes storing one record per term.
+    """
     indexrecord_class = None
 
+    # Either NLTK_TOKENIZER or REGEX_TOKENIZER, None uses the SEARCH_TOKENIZER setting
+    tokenizer = None
+
+    # Either INLINE_COUNTS or LOG_COUNTS, None uses the SEARCH_COUNT_MODE setting
+    count_mode = None
+
     def __init__(self):
         if not getattr(self, 'indexrecord_class', None):
             raise Exception("Misconfigured %s: indexrecord_class needs to be set." % self.__class__)
@@ -95,10 +361,20 @@ class AbstractIndex(object):
         """ Get all index records that belong to an object. """
         raise NotImplementedError("Subclasses should implement this.")
 
-    def get_or_create_record(self, obj, field, iexact, occurances):
-        """ Simple wrapper around get_or_create to all different index classes to specify how to create the record.
-            Returns a tuple of (record, created), just like get_or_create
-        """
+    def unindex(self, obj):
+        """ Delete the index records of an object and subtract their terms from the counts. """
+        raise NotImplementedError("Subclasses should implement this.")
+
+    def _do_index(self, obj, fields_to_index, defer_index=True):
+        """ Write the index records of an object. """
+        raise NotImplementedError("Subclasses should implement this.")
+
+    def _get_term_filters(self, terms):
+        """ Filters selecting the index records which contain any of terms. """
+        raise NotImplementedError("Subclasses should implement this.")
+
+    def _get_record_counts(self, record, count_keys):
+        """ A list of (count key, occurances) for the terms in record whose count key is in count_keys. """
         raise NotImplementedError("Subclasses should implement this.")
 
     def search(self, *args, **kwargs):
@@ -107,33 +383,70 @@ class AbstractIndex(object):
 
     # End of unimplemented methods.
 
+    def _change_counts(self, deltas):
+        """ Apply a dict of {term: delta} to the GlobalOccuranceCounts, or log it when using the count log. """
+        if self.uses_count_log():
+            log_count_deltas(deltas)
+        else:
+            apply_count_deltas(deltas)
+
+    def uses_count_log(self):
+        """ Whether GlobalOccuranceCount changes are logged for fold_count_deltas rather than applied inline. """
+        count_mode = self.count_mode or SEARCH_COUNT_MODE
+        if count_mode not in (INLINE_COUNTS, LOG_COUNTS):
+            raise Exception("Simple_search misconfigured, unknown count mode %s in %s" % (count_mode, self.__class__))
+        return count_mode == LOG_COUNTS
+
     def index(self, obj, fields_to_index, defer_index=True):
         """ Index an object. Will defer the indexing if defer_index is true or if called inside a transaction.
             Indexing an object will always unindex the object first.
         """
-        if db.is_in_transaction() or defer_index:
-            defer(self.reindex, obj, fields_to_index, defer_index=defer_index, _queue=QUEUE_FOR_INDEXING)
-        else:
-            self.reindex(obj, fields_to_index, defer_index=defer_index)
+        with operation(index_completed, self.__class__, "index", defer_index=defer_index) as op:
+            if db.is_in_transaction() or defer_index:
+                with op.phase("defer"):
+                    defer(self.reindex, obj, fields_to_index, defer_index=defer_index, _queue=QUEUE_FOR_INDEXING)
+            else:
+                self.reindex(obj, fields_to_index, defer_index=defer_index)
 
     def reindex(self, obj, fields_to_index, defer_index=True):
         """ Unindex the object, then call _do_index to do the actual indexing work. """
-        self.unindex(obj)
-        self._do_index(obj, fields_to_index, defer_index=defer_index)
+        with operation(index_completed, self.__class__, "reindex", defer_index=defer_index) as op:
+            with op.phase("unindex"):
+                self.unindex(obj)
+            self._do_index(obj, fields_to_index, defer_index=defer_index)
 
-    def unindex(self, obj):
-        """ Unindex an object by deleting all records referencing it. """
+    def get_ngram_policy(self, obj, field=None):
+        """ The n-gram policy (see DEFAULT_NGRAM_POLICY) for a field of obj, which can be an instance or a model class. """
+        policy = dict(DEFAULT_NGRAM_POLICY)
 
-        records = self._get_records(obj)
-        for record in list(records):
-            try:
-                record.delete()
-            except AssertionError:
-                logging.exception("Something went wrong while unindexing an index record.")
+        search = getattr(obj, "Search", None)
+        if search is not None:
+            policy.update(getattr(search, "ngrams", {}))
+            if field is not None:
+                policy.update(getattr(search, "field_ngrams", {}).get(field, {}))
+
+        if policy["max_length"] < 1:
+            raise Exception("Simple_search misconfigured, ngram max_length must be at least 1 for %s" % obj)
+        return policy
+
+    def _count_key(self, term):
+        """ The GlobalOccuranceCount key for a term. """
+        return term
+
+    def _get_common_words(self, words, policy):
+        """ The subset of a set of canonicalized words which policy treats as too common for n-grams. """
+        common = set(itertools.chain(*[self.canonicalize(x) for x in policy["common_terms"]])) & words
+
+        threshold = policy["common_threshold"]
+        if threshold is not None:
+            common_keys = get_common_count_keys(threshold)
+            common.update(word for word in words if self._count_key(word) in common_keys)
 
-    def _generate_terms(self, text):
+        return common
+
+    def _generate_terms(self, text, policy=None):
         """ Takes a string, splits it into words and generates a list of combinations of adjacent words.
-            The terms are limited to 4 words in length.
+            The terms are limited to policy["max_length"] words in length, see DEFAULT_NGRAM_POLICY.
 
             Example:
             Input: "Yo, what's up?"
@@ -142,61 +455,76 @@ class AbstractIndex(object):
         if text is None:
             return []
 
-        stems = self.canonicalize(text)
+        policy = policy or DEFAULT_NGRAM_POLICY
+
+        if policy["phrase_boundaries"]:
+            phrases = [self.canonicalize(phrase) for phrase in _PHRASE_BOUNDARIES_RE.split(text)]
+        else:
+            phrases = [self.canonicalize(text)]
+
+        common = set()
+        if policy["common_terms"] or policy["common_threshold"] is not None:
+            common = self._get_common_words(set(itertools.chain(*phrases)), policy)
 
         terms = []
-        #Build up combinations of adjacent words
-        for i in xrange(0, len(stems)):
-            for j in xrange(1, 5):
-                term_words = stems[i:i+j]
+        for stems in phrases:
+            #Build up combinations of adjacent words
+            for i in xrange(0, len(stems)):
+                for j in xrange(1, policy["max_length"] + 1):
+                    term_words = stems[i:i+j]
 
-                if len(term_words) != j:
-                    break
+                    if len(term_words) != j:
+                        break
 
-                term = u" ".join(term_words)
+                    if j > 1 and common and all(word in common for word in term_words):
+                        continue
 
-                if not term.strip():
-                    continue
-                terms.append(term)
-        return terms
+                    term = u" ".join(term_words)
 
-    def _index_term(self, obj, field, text, term):
-        # FIXME: I've had to disable this transaction because get_or_create doesn't work inside transactions
-        # It also doesn't (reliably) work outside transactions. This can be reenabled once djangae has unique-caching.
-        #@db.transactional(xg=True)
-        text = ' '.join(self.canonicalize(text))
-        def txn(term_):
-            #logging.info("Indexing: '%s', %s", term_, type(term_))
-            term_count = text.count(term_)
-            self.get_or_create_record(obj, field, term_, term_count)
-
-            counter, created = GlobalOccuranceCount.objects.get_or_create(pk=term_)
-            counter.count += term_count
-            counter.save()
-        while True:
-            try:
-                txn(term)
-                break
-            except db.TransactionFailedError:
-                logging.warning("Transaction collision, retrying!")
-                time.sleep(1)
-                continue
+                    if not term.strip():
+                        continue
+                    terms.append(term)
+        return terms
 
-    def _do_index(self, obj, fields_to_index, defer_index=True):
-        """ Index an object. Fields_to_index can refer to instance attributes or dictionary keys,
-            self.get_field_data is used to get the actual data, which can be overwritten for specific requirements.
+    def _get_ngram_policies(self, model_class):
+        """ The distinct n-gram policies of model_class and its fields. """
+        search = getattr(model_class, "Search", None)
+        fields = [None] + list(getattr(search, "field_ngrams", {}))
+        policies = []
+        for policy in (self.get_ngram_policy(model_class, field) for field in fields):
+            if policy not in policies:
+                policies.append(policy)
+        return policies
+
+    def _uses_common_threshold(self, model_class):
+        return any(policy["common_threshold"] is not None for policy in self._get_ngram_policies(model_class))
+
+    def _fit_terms_to_policy(self, model_class, terms):
+        """ Make the parsed search terms match what's indexed for model_class: quoted phrases longer than the
+            shortest n-gram limit of any field are split into overlapping n-grams, and phrases of only words
+            which any field treats as common (so might not be indexed) are split into their words.
         """
-        logging.info("[SIMPLE_SEARCH] Indexing object %s, spawning _index_term tasks" % obj)
-        for field in fields_to_index:
-            texts = self.get_field_data(field, obj)
-
-            for text in texts:
-                terms = self._generate_terms(text)
-                for term in terms:
-                    if defer_index:
-                        defer(self._index_term, obj, field, text, term, _queue=settings.QUEUE_FOR_INDEXING)
-                    else:
-                        self._index_term(obj, field, text, term)
+        policies = self._get_ngram_policies(model_class)
+        max_length = min(policy["max_length"] for policy in policies)
+
+        phrases = [term.split(u" ") for term in terms if u" " in term]
+        common = set()
+        if phrases:
+            words = set(itertools.chain(*phrases))
+            for policy in policies:
+                if policy["common_terms"] or policy["common_threshold"] is not None:
+                    common.update(self._get_common_words(words, policy))
+
+        fitted = []
+        for term in terms:
+            words = term.split(u" ")
+            if common and all(word in common for word in words):
+                fitted.extend(words)
+            elif len(words) > max_length:
+                fitted.extend(u" ".join(words[i:i + max_length]) for i in xrange(len(words) - max_length + 1))
+            else:
+                fitted.append(term)
+        return fitted
 
     def _weight_results(self, obj_weights):
         """
@@ -230,25 +558,86 @@ class AbstractIndex(object):
         # just return the match objects
         return [x[1] for x in final_weights]
 
-    def _get_matches(self, terms, extra_filters=None):
-        matching_terms = dict(list(GlobalOccuranceCount.objects.filter(pk__in=terms).values_list('pk', 'count')))
+    def _get_ranked_ids(self, obj_weights, max_results):
+        """ The ids of the matched objects (see OBJECT_ID_FIELD) from best to worst, without duplicates. """
+        object_ids = []
+        seen = set()
+
+        for weight, record in self._weight_results(obj_weights):
+            object_id = getattr(record, record.OBJECT_ID_FIELD)
+            if object_id not in seen:
+                seen.add(object_id)
+                object_ids.append(object_id)
+                if len(object_ids) == max_results:
+                    break
+
+        return object_ids
+
+    def _get_matches(self, terms, extra_filters=None, split_unmatched=False):
+        """ Returns {match: [GlobalOccuranceCount of the searched terms in it]} for every index record containing
+            any of terms, where a match is what _get_term_match makes of a record and one of its terms.
+
+            With split_unmatched, phrases which match nothing are searched again as their words. Use this with a
+            common_threshold: a phrase's words may have been common, so the phrase not indexed, when a record was
+            written, even though they aren't common now.
+        """
+        count_keys = set(self._count_key(term) for term in terms)
+        if not count_keys:
+            return {}
+
+        with phase("global_counts"):
+            matching_terms = dict(GlobalOccuranceCount.objects.filter(pk__in=list(count_keys)).values_list('pk', 'count'))
+        set_count("global_counts", len(matching_terms))
 
-        filter_args = {'iexact__in': terms}
+        filter_args = self._get_term_filters(terms)
         if extra_filters:
             filter_args.update(extra_filters)
 
-        matches = self.indexrecord_class.objects.filter(**filter_args).all()
+        with phase("index_records"):
+            matches = list(self.indexrecord_class.objects.filter(**filter_args).all())
+        set_count("index_records", len(matches))
 
-        obj_weights = {}
+        record_counts = [(match, self._get_record_counts(match, count_keys)) for match in matches]
+        if self.uses_count_log():
+            matching_terms.update(self._estimate_counts(record_counts, matching_terms))
 
-        for match in matches:
-            try:
-                obj_weights.setdefault(match, []).append(matching_terms[match.iexact])
-            except:
-                logging.critical("[_get_matches] %s wasn't found in matching_terms. Not adding this match to obj_weights" % match.iexact)
+        obj_weights = {}
+        for match, counts in record_counts:
+            for count_key, occurances in counts:
+                try:
+                    obj_weights.setdefault(self._get_term_match(match, count_key), []).append(matching_terms[count_key])
+                except KeyError:
+                    logging.critical("[_get_matches] %s wasn't found in matching_terms. Not adding this match to obj_weights" % count_key)
+
+        if split_unmatched:
+            found = set(count_key for match, counts in record_counts for count_key, occurances in counts)
+            words = set(itertools.chain(*[
+                term.split(u" ") for term in terms if u" " in term and self._count_key(term) not in found
+            ])) - set(terms)
+            if words:
+                for match, weights in self._get_matches(list(words), extra_filters).items():
+                    obj_weights.setdefault(match, []).extend(weights)
 
         return obj_weights
 
+    def _get_term_match(self, record, count_key):
+        """ What a matched term of record is ranked as. Each term is ranked on its own, so an object ranks by its
+            rarest matched term however its terms are split between records.
+        """
+        return record
+
+    @staticmethod
+    def _estimate_counts(record_counts, counts):
+        """ Counts lag behind the index records when using the count log, estimate any that haven't been
+            folded in yet from the occurances in the matched records.
+        """
+        estimated_counts = defaultdict(int)
+        for record, record_terms in record_counts:
+            for count_key, occurances in record_terms:
+                if count_key not in counts:
+                    estimated_counts[count_key] += occurances
+        return estimated_counts
+
     def _apply_paging_to_results(self, final_weights, per_page, current_page, total_pages):
         #Restrict to the max possible
         final_weights = final_weights[:total_pages*per_page]
@@ -321,7 +710,7 @@ class AbstractIndex(object):
             stemmer = nltk.stem.porter.PorterStemmer()
 
         normalized = cls.normalize(raw)
-        tokenized = nltk.word_tokenize(normalized)
+        tokenized = cls.tokenize(normalized)
 
         tokens = []
         for token in tokenized:
@@ -340,6 +729,16 @@ class AbstractIndex(object):
 
         return tokens
 
+    @classmethod
+    def tokenize(cls, normalized):
+        """ Split normalized text into tokens using the tokenizer configured for this index. """
+        tokenizer = cls.tokenizer or SEARCH_TOKENIZER
+        if tokenizer == REGEX_TOKENIZER:
+            return regex_tokenize(normalized)
+        if tokenizer == NLTK_TOKENIZER:
+            return nltk.word_tokenize(normalized)
+        raise Exception("Simple_search misconfigured, unknown tokenizer %s in %s" % (tokenizer, cls))
+
     @staticmethod
     def normalize(s):
         whitespace_characters = u'|/-–—~,.;:!?'
@@ -411,3 +810,95 @@ class AbstractIndex(object):
 
             parsed_terms[field].extend(canon_terms)
         return parsed_terms
+
+
+class AbstractIndex(BaseIndex):
+    """ An index storing a record per term in each indexed field of an object. """
+
+    def get_or_create_record(self, obj, field, iexact, occurances):
+        """ Simple wrapper around get_or_create to all different index classes to specify how to create the record.
+            Returns a tuple of (record, created), just like get_or_create
+        """
+        raise NotImplementedError("Subclasses should implement this.")
+
+    # End of unimplemented methods.
+
+    def unindex(self, obj):
+        """ Unindex an object by deleting all records referencing it. """
+        with operation(index_completed, self.__class__, "unindex") as op:
+            with op.phase("fetch_records"):
+                records = list(self._get_records(obj))
+            op.incr("records_deleted", len(records))
+
+            if self.uses_count_log():
+                deltas = defaultdict(int)
+                with op.phase("delete_records"):
+                    for record in records:
+                        record.delete_record()
+                        deltas[record.iexact] -= record.occurances
+
+                with op.phase("log_counts"):
+                    log_count_deltas(deltas)
+                return
+
+            failed_deltas = {}
+            with op.phase("delete_records"):
+                for record in records:
+                    try:
+                        record._delete_with_count(failed_deltas)
+                    except AssertionError:
+                        logging.exception("Something went wrong while unindexing an index record.")
+
+            if failed_deltas:
+                defer_count_deltas(failed_deltas)
+
+    def _index_term(self, obj, field, text, term):
+        # FIXME: I've had to disable this transaction because get_or_create doesn't work inside transactions
+        # It also doesn't (reliably) work outside transactions. This can be reenabled once djangae has unique-caching.
+        #@db.transactional(xg=True)
+        with operation(index_completed, self.__class__, "index_term") as op:
+            with op.phase("canonicalize"):
+                term_count = ' '.join(self.canonicalize(text)).count(term)
+
+            with op.phase("write_record"):
+                try:
+                    retry_transaction(self.get_or_create_record, obj, field, term, term_count)
+                except db.TransactionFailedError:
+                    logging.warning("Couldn't create index record for '%s', deferring", term)
+                    defer(self._index_term, obj, field, text, term,
+                          _queue=QUEUE_FOR_INDEXING, _countdown=COUNT_RECONCILE_DELAY)
+                    return
+
+            with op.phase("write_count"):
+                if self.uses_count_log():
+                    log_count_deltas({term: term_count})
+                else:
+                    change_count(term, term_count)
+            op.incr("terms_written")
+
+    def _do_index(self, obj, fields_to_index, defer_index=True):
+        """ Index an object. Fields_to_index can refer to instance attributes or dictionary keys,
+            self.get_field_data is used to get the actual data, which can be overwritten for specific requirements.
+        """
+        logging.info("[SIMPLE_SEARCH] Indexing object %s, spawning _index_term tasks" % obj)
+        for field in fields_to_index:
+            with phase("get_field_data"):
+                texts = self.get_field_data(field, obj)
+            policy = self.get_ngram_policy(obj, field)
+
+            for text in texts:
+                with phase("generate_terms"):
+                    terms = self._generate_terms(text, policy)
+                incr("terms", len(terms))
+                for term in terms:
+                    if defer_index:
+                        with phase("defer_terms"):
+                            defer(self._index_term, obj, field, text, term, _queue=settings.QUEUE_FOR_INDEXING)
+                    else:
+                        self._index_term(obj, field, text, term)
+
+    def _get_term_filters(self, terms):
+        return {'iexact__in': terms}
+
+    def _get_record_counts(self, record, count_keys):
+        return [(record.iexact, record.occurances)]
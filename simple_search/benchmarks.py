@@ -0,0 +1,396 @@
+""" Benchmarks for simple_search's hot paths. Run them with "manage.py search_benchmark".
+
+    Benchmarks which touch the datastore are run against the Django test database, so they never
+    see or modify real index data.
+"""
+
+import bisect
+import random
+import string
+import time
+from collections import Counter
+
+from django.db import models
+from django.utils.encoding import smart_str
+
+from base_models import (
+    AbstractIndex, DEFAULT_NGRAM_POLICY, GlobalOccuranceCount, GlobalOccuranceDelta, LOG_COUNTS, NLTK_TOKENIZER,
+    REGEX_TOKENIZER, fold_count_deltas
+)
+from models import CompactIndexRecord, Index, IndexRecord, compact_index, index
+from instrumentation import nearest_rank
+
+
+TEST_CORPUS = [
+    u"bananas apples cherries plums oranges kiwi",
+    u"a search term with some unique words banana fish",
+    u"another search term with a unique word fish",
+    u"not so unique",
+    u"Banana",
+    u"Cherry",
+    u"__testing__",
+    u"how__ do you like __dem__ apples",
+    u"a it the development at if",
+    u"This:isn't a field",
+    u"key:value also multiple things",
+    u"Yo, what's up? I can't believe it's already 5 o'clock!",
+    u"The quick brown fox (allegedly) jumped over the lazy dog's kennel.",
+    u"Email support@example.com or call +44 1234 567 890 - 24/7 & 365 days a year.",
+    u"She said \"we're gonna need a bigger boat\" and walked off; nobody argued.",
+    u"Prices start at $5 [VAT inc.] for 100% organic, free-range produce.",
+    u"Don't, won't, shouldn't've: contractions are the tokenizer's worst enemy.",
+]
+
+
+class BenchmarkDocument(models.Model):
+    text = models.TextField()
+
+    class Meta:
+        app_label = "simple_search"
+
+
+class CountLogIndex(Index):
+    count_mode = LOG_COUNTS
+
+count_log_index = CountLogIndex()
+
+
+class NgramPolicyIndex(Index):
+    """ An Index using the same n-gram policy for every object and field. """
+    def __init__(self, **policy):
+        super(NgramPolicyIndex, self).__init__()
+        self.policy = dict(DEFAULT_NGRAM_POLICY, **policy)
+
+    def get_ngram_policy(self, obj, field=None):
+        return self.policy
+
+
+class NltkTokenizerIndex(AbstractIndex):
+    tokenizer = NLTK_TOKENIZER
+
+
+class RegexTokenizerIndex(AbstractIndex):
+    tokenizer = REGEX_TOKENIZER
+
+
+def generate_corpus(documents=200, words_per_document=50, vocabulary=2000, skew=1.0, seed=0, sentence_length=12):
+    """ Generate a list of documents made up of random words.
+
+        Word frequencies follow a Zipf distribution: the word with rank r is picked with a probability
+        proportional to 1 / r ** skew, so a skew of 0 gives a uniform vocabulary and higher skews make
+        the most common words dominate. Sentences end with a full stop after sentence_length words on average.
+    """
+    rand = random.Random(seed)
+
+    words = set()
+    while len(words) < vocabulary:
+        words.add(u"".join(rand.choice(string.ascii_lowercase) for i in xrange(rand.randint(4, 9))))
+    words = sorted(words)
+    rand.shuffle(words)
+
+    cumulative_weights = []
+    total = 0.0
+    for rank in xrange(1, vocabulary + 1):
+        total += 1.0 / rank ** skew
+        cumulative_weights.append(total)
+
+    def pick_word():
+        word = words[bisect.bisect(cumulative_weights, rand.random() * total)]
+        if sentence_length and rand.random() < 1.0 / sentence_length:
+            word += u"."
+        return word
+
+    return [u" ".join(pick_word() for j in xrange(words_per_document)) for i in xrange(documents)]
+
+
+def _time(func, repeat):
+    """ Call func repeat times and return the total number of seconds taken. """
+    start = time.time()
+    for i in xrange(repeat):
+        func()
+    return time.time() - start
+
+
+def _summarize(samples):
+    """ Summarize a list of per-call durations (in seconds) as milliseconds. """
+    if not samples:
+        return {"calls": 0}
+
+    samples = sorted(samples)
+    return {
+        "calls": len(samples),
+        "total_ms": sum(samples) * 1000,
+        "mean_ms": sum(samples) * 1000 / len(samples),
+        "min_ms": samples[0] * 1000,
+        "p50_ms": nearest_rank(samples, 50) * 1000,
+        "p90_ms": nearest_rank(samples, 90) * 1000,
+        "p99_ms": nearest_rank(samples, 99) * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+
+
+def _sample(func, args_list, repeat=1):
+    """ Call func once for each item of args_list, repeat times over, timing each call individually. """
+    samples = []
+    for i in xrange(repeat):
+        for args in args_list:
+            start = time.time()
+            func(*args)
+            samples.append(time.time() - start)
+    return _summarize(samples)
+
+
+def _throughput(index_class, corpus, repeat):
+    def run():
+        for text in corpus:
+            index_class.canonicalize(text)
+
+    # Warm up first so loading stopwords and models isn't counted
+    run()
+    seconds = _time(run, repeat)
+    return {
+        "seconds": seconds,
+        "texts_per_second": (len(corpus) * repeat) / seconds if seconds else None,
+    }
+
+
+def compare_tokenizers(corpus=TEST_CORPUS, repeat=20):
+    """ Compare canonicalize() throughput and the terms produced using the nltk and regex tokenizers. """
+    identical = 0
+    shared_terms = 0
+    total_terms = 0
+    differences = []
+
+    for text in corpus:
+        nltk_terms = NltkTokenizerIndex.canonicalize(text)
+        regex_terms = RegexTokenizerIndex.canonicalize(text)
+
+        if nltk_terms == regex_terms:
+            identical += 1
+        else:
+            differences.append({"text": text, "nltk": nltk_terms, "regex": regex_terms})
+
+        nltk_counts, regex_counts = Counter(nltk_terms), Counter(regex_terms)
+        shared_terms += sum((nltk_counts & regex_counts).values())
+        total_terms += sum((nltk_counts | regex_counts).values())
+
+    return {
+        "texts": len(corpus),
+        "repeat": repeat,
+        "nltk": _throughput(NltkTokenizerIndex, corpus, repeat),
+        "regex": _throughput(RegexTokenizerIndex, corpus, repeat),
+        "identical_texts": identical,
+        "term_agreement": float(shared_terms) / total_terms if total_terms else 1.0,
+        "differences": differences,
+    }
+
+
+def _generate_queries(corpus):
+    """ Build a handful of queries from the corpus: common and rare words, multiple words and a quoted phrase. """
+    counts = Counter(word.strip(u".") for text in corpus for word in text.split())
+    by_frequency = [word for word, count in counts.most_common()]
+    first_document = corpus[0].split()
+    return {
+        "common_word": by_frequency[0],
+        "rare_word": by_frequency[-1],
+        "two_words": u" ".join(by_frequency[:2]),
+        "mixed_words": u" ".join([by_frequency[0], by_frequency[len(by_frequency) // 2], by_frequency[-1]]),
+        "phrase": u'"%s"' % u" ".join(first_document[:3]),
+    }
+
+
+def _create_documents(corpus):
+    return [BenchmarkDocument.objects.create(text=text) for text in corpus]
+
+
+def _clear_datastore():
+    BenchmarkDocument.objects.all().delete()
+    IndexRecord.objects.all().delete()
+    GlobalOccuranceCount.objects.all().delete()
+    GlobalOccuranceDelta.objects.all().delete()
+    CompactIndexRecord.objects.all().delete()
+
+
+def _fold_all_deltas():
+    while GlobalOccuranceDelta.objects.exists():
+        fold_count_deltas()
+
+
+def benchmark_tokenizers(corpus, repeat):
+    return compare_tokenizers(TEST_CORPUS, repeat)
+
+
+def benchmark_canonicalize(corpus, repeat):
+    return _sample(AbstractIndex.canonicalize, [(text,) for text in corpus], repeat)
+
+
+def benchmark_generate_terms(corpus, repeat):
+    return _sample(index._generate_terms, [(text,) for text in corpus], repeat)
+
+
+def benchmark_parse_terms(corpus, repeat):
+    queries = _generate_queries(corpus)
+    return dict(
+        (name, _sample(AbstractIndex.parse_terms, [(query,)], repeat))
+        for name, query in queries.items()
+    )
+
+
+def benchmark_index(corpus, repeat):
+    """ Index every document in the corpus, both inline and deferred. Deferring only measures queueing the work.
+        Indexing with the count log is measured separately, along with folding the logged deltas afterwards.
+    """
+    documents = _create_documents(corpus)
+    try:
+        results = {
+            "index": _sample(index.index, [(document, ["text"], False) for document in documents]),
+            "records": IndexRecord.objects.count(),
+            "global_counts": GlobalOccuranceCount.objects.count(),
+            "index_deferred": _sample(index.index, [(document, ["text"], True) for document in documents]),
+        }
+    finally:
+        _clear_datastore()
+
+    documents = _create_documents(corpus)
+    try:
+        results["index_count_log"] = _sample(count_log_index.index, [(document, ["text"], False) for document in documents])
+        results["count_deltas"] = GlobalOccuranceDelta.objects.count()
+        results["fold_count_deltas"] = _sample(_fold_all_deltas, [()])
+    finally:
+        _clear_datastore()
+    return results
+
+
+def _record_bytes(record):
+    """ Rough size of the values stored in a record, ignoring datastore overheads and indexes. """
+    if isinstance(record, CompactIndexRecord):
+        return len(record.id) + 8 * 3 + 8 * len(record.terms) + len(record.occurances)
+    return len(smart_str(record.iexact)) + len(record.instance_db_table) + len(record.field) + 8 * 3
+
+
+def benchmark_storage(corpus, repeat):
+    """ Compare the number and size of the records written by Index and CompactIndex, and their indexing speed. """
+    results = {}
+    for name, index_ in [("index", index), ("compact_index", compact_index)]:
+        documents = _create_documents(corpus)
+        try:
+            timings = _sample(index_.index, [(document, ["text"], False) for document in documents])
+            records = list(index_.indexrecord_class.objects.all())
+            results[name] = {
+                "index": timings,
+                "records": len(records),
+                "record_bytes": sum(_record_bytes(record) for record in records),
+                "global_counts": GlobalOccuranceCount.objects.count(),
+                "search": _sample(index_.search, [(BenchmarkDocument, query) for query in _generate_queries(corpus).values()], repeat),
+            }
+        finally:
+            _clear_datastore()
+    return results
+
+
+def benchmark_ngrams(corpus, repeat):
+    """ Compare the terms generated, records written and indexing speed for different n-gram policies. """
+    common_words = [word for word, count in Counter(
+        word.strip(u".") for text in corpus for word in text.split()).most_common(20)]
+
+    policies = {
+        "default": {},
+        "max_length_1": {"max_length": 1},
+        "max_length_2": {"max_length": 2},
+        "max_length_3": {"max_length": 3},
+        "phrase_boundaries": {"phrase_boundaries": True},
+        "common_terms": {"common_terms": common_words},
+        "max_length_2_phrase_boundaries_common_terms": {
+            "max_length": 2, "phrase_boundaries": True, "common_terms": common_words
+        },
+    }
+
+    results = {}
+    for name, policy in policies.items():
+        index_ = NgramPolicyIndex(**policy)
+        documents = _create_documents(corpus)
+        try:
+            results[name] = {
+                "policy": index_.policy,
+                "terms": sum(len(index_._generate_terms(text, index_.policy)) for text in corpus),
+                "generate_terms": _sample(index_._generate_terms, [(text, index_.policy) for text in corpus], repeat),
+                "index": _sample(index_.index, [(document, ["text"], False) for document in documents]),
+                "records": IndexRecord.objects.count(),
+                "global_counts": GlobalOccuranceCount.objects.count(),
+            }
+        finally:
+            _clear_datastore()
+    return results
+
+
+def benchmark_unindex(corpus, repeat):
+    documents = _create_documents(corpus)
+    try:
+        for document in documents:
+            index.index(document, ["text"], defer_index=False)
+        results = {
+            "unindex": _sample(index.unindex, [(document,) for document in documents]),
+        }
+    finally:
+        _clear_datastore()
+    return results
+
+
+def benchmark_search(corpus, repeat, per_page=10):
+    """ Time the first, middle and last page of each query with page numbers, and every page with cursors.
+        The pages measured depend on how many results each query has, see "results" in the output.
+    """
+    documents = _create_documents(corpus)
+    try:
+        for document in documents:
+            index.index(document, ["text"], defer_index=False)
+
+        def page_through(query):
+            """ Fetch every page of results with cursors, returning the seconds taken for each page and the
+                number of results.
+            """
+            seconds = []
+            result_count = 0
+            cursor = None
+            while True:
+                start = time.time()
+                instances, cursor = index.search_with_cursor(BenchmarkDocument, query, cursor=cursor, per_page=per_page)
+                seconds.append(time.time() - start)
+                result_count += len(instances)
+                if cursor is None:
+                    return seconds, result_count
+
+        results = {}
+        for name, query in _generate_queries(corpus).items():
+            cursor_pages = [page_through(query) for i in xrange(repeat)]
+            result_count = cursor_pages[0][1]
+
+            last_page = max(1, (result_count + per_page - 1) // per_page)
+            pages = sorted(set([1, (last_page + 1) // 2, last_page]))
+            results[name] = dict(
+                ("page_%s" % page, _sample(index.search, [(BenchmarkDocument, query, per_page, page, last_page)], repeat))
+                for page in pages
+            )
+
+            results[name]["results"] = result_count
+            results[name]["cursor_first_page"] = _summarize([seconds[0] for seconds, count in cursor_pages])
+            results[name]["cursor_later_pages"] = _summarize([y for seconds, count in cursor_pages for y in seconds[1:]])
+    finally:
+        _clear_datastore()
+    return results
+
+
+BENCHMARKS = {
+    "tokenizers": benchmark_tokenizers,
+    "canonicalize": benchmark_canonicalize,
+    "generate_terms": benchmark_generate_terms,
+    "parse_terms": benchmark_parse_terms,
+    "index": benchmark_index,
+    "unindex": benchmark_unindex,
+    "search": benchmark_search,
+    "storage": benchmark_storage,
+    "ngrams": benchmark_ngrams,
+}
+
+# Benchmarks that need the test database to be set up
+DATASTORE_BENCHMARKS = ("index", "unindex", "search", "storage", "ngrams")
@@ -0,0 +1,200 @@
+""" Instrumentation hooks for searches and index operations.
+
+    Connect a receiver to search_completed or index_completed to get an Operation once each search or
+    index operation finishes. An Operation has the operation name, a dict of per-phase timings in seconds
+    (phases can nest, "total" covers the whole operation) and a dict of counters such as rows read,
+    candidate set sizes, search cursor cache hits and transaction retries.
+
+    When no receiver is connected nothing is timed or counted, so the hooks cost next to nothing.
+
+        aggregator = Aggregator()
+        aggregator.connect()
+        ...
+        aggregator.summary()  # {"search": {"time.total": {"samples": 10, "p50": ..., "p90": ..., "p99": ...}}}
+"""
+
+import collections
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+
+search_completed = Signal(providing_args=["operation"])
+index_completed = Signal(providing_args=["operation"])
+
+_local = threading.local()
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, operation, name):
+        self.operation = operation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        timings = self.operation.timings
+        timings[self.name] = timings.get(self.name, 0) + time.time() - self.start
+        return False
+
+
+class NullOperation(object):
+    """ Used in place of an Operation when nothing is listening. Everything is a no-op. """
+    name = None
+
+    def phase(self, name):
+        return _NULL_PHASE
+
+    def incr(self, name, amount=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+NULL_OPERATION = NullOperation()
+
+
+class Operation(object):
+    def __init__(self, name, **info):
+        self.name = name
+        self.info = info
+        self.timings = {}
+        self.counts = {}
+        self.error = None
+
+    def phase(self, name):
+        """ Returns a context manager which adds the time spent inside it to timings[name]. """
+        return _Phase(self, name)
+
+    def incr(self, name, amount=1):
+        self.counts[name] = self.counts.get(name, 0) + amount
+
+    def set(self, name, value):
+        self.counts[name] = value
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "info": self.info,
+            "timings": self.timings,
+            "counts": self.counts,
+            "error": self.error,
+        }
+
+
+def nearest_rank(values, p):
+    """ The p-th percentile of a sorted list of values, by the nearest rank method. """
+    return values[max(0, int(math.ceil(len(values) * p / 100.0)) - 1)]
+
+
+def current():
+    """ The operation running in this thread, or NULL_OPERATION. """
+    return getattr(_local, "operation", None) or NULL_OPERATION
+
+
+def phase(name):
+    return current().phase(name)
+
+
+def incr(name, amount=1):
+    current().incr(name, amount)
+
+
+def set_count(name, value):
+    current().set(name, value)
+
+
+@contextmanager
+def operation(signal, sender, name, **info):
+    """ Instrument the block as an operation, sending signal with the Operation when it finishes.
+        Operations started inside another operation (e.g. reindex inside index) are folded into the outer one.
+    """
+    active = getattr(_local, "operation", None)
+    if active is not None:
+        yield active
+        return
+
+    if not signal.has_listeners(sender):
+        yield NULL_OPERATION
+        return
+
+    op = Operation(name, **info)
+    _local.operation = op
+    start = time.time()
+    try:
+        yield op
+    except Exception as e:
+        op.error = repr(e)
+        raise
+    finally:
+        op.timings["total"] = time.time() - start
+        _local.operation = None
+        signal.send(sender=sender, operation=op)
+
+
+class Aggregator(object):
+    """ Collects the timings and counts of completed operations and reports percentiles over them.
+        Only the most recent max_samples values of each metric are kept.
+    """
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def connect(self):
+        search_completed.connect(self.receive)
+        index_completed.connect(self.receive)
+
+    def disconnect(self):
+        search_completed.disconnect(self.receive)
+        index_completed.disconnect(self.receive)
+
+    def reset(self):
+        with self._lock:
+            self._samples = {}
+
+    def receive(self, sender, operation, **kwargs):
+        metrics = [("time.%s" % name, value) for name, value in operation.timings.items()]
+        metrics.extend(operation.counts.items())
+
+        with self._lock:
+            samples = self._samples.setdefault(operation.name, {})
+            for metric, value in metrics:
+                samples.setdefault(metric, collections.deque(maxlen=self.max_samples)).append(value)
+
+    def percentiles(self, operation_name, metric, percentiles=(50, 90, 99)):
+        """ Returns {"samples": n, "p50": ..., ...} for a metric of an operation, or None if nothing was recorded. """
+        with self._lock:
+            values = sorted(self._samples.get(operation_name, {}).get(metric, []))
+
+        if not values:
+            return None
+
+        result = {"samples": len(values)}
+        for p in percentiles:
+            result["p%s" % p] = nearest_rank(values, p)
+        return result
+
+    def summary(self, percentiles=(50, 90, 99)):
+        with self._lock:
+            keys = [(name, metric) for name, metrics in self._samples.items() for metric in metrics]
+
+        summary = {}
+        for name, metric in keys:
+            summary.setdefault(name, {})[metric] = self.percentiles(name, metric, percentiles)
+        return summary
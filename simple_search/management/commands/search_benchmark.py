@@ -0,0 +1,80 @@
+import datetime
+import json
+import platform
+import subprocess
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from simple_search import benchmarks
+
+
+def _get_git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = "Run simple_search benchmarks against a synthetic corpus and print the results as JSON."
+    args = "[benchmark ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--repeat", type="int", default=20, help="Number of times to repeat each timed run."),
+        make_option("--documents", type="int", default=200, help="Number of documents in the synthetic corpus."),
+        make_option("--words", type="int", default=50, help="Number of words in each document."),
+        make_option("--vocabulary", type="int", default=2000, help="Number of distinct words in the corpus."),
+        make_option("--skew", type="float", default=1.0, help="Zipf exponent for word frequencies, 0 is uniform."),
+        make_option("--seed", type="int", default=0, help="Random seed used to generate the corpus."),
+        make_option("--sentence-length", dest="sentence_length", type="int", default=12,
+                    help="Average number of words in a sentence, 0 leaves out punctuation."),
+        make_option("--output", default=None, help="Write the JSON results to this file instead of stdout."),
+    )
+
+    def handle(self, *args, **options):
+        names = args or sorted(benchmarks.BENCHMARKS.keys())
+        unknown = [name for name in names if name not in benchmarks.BENCHMARKS]
+        if unknown:
+            raise CommandError("Unknown benchmark(s): %s" % ", ".join(unknown))
+
+        corpus_options = {
+            "documents": options["documents"],
+            "words_per_document": options["words"],
+            "vocabulary": options["vocabulary"],
+            "skew": options["skew"],
+            "seed": options["seed"],
+            "sentence_length": options["sentence_length"],
+        }
+        corpus = benchmarks.generate_corpus(**corpus_options)
+
+        results = {
+            "revision": _get_git_revision(),
+            "timestamp": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "repeat": options["repeat"],
+            "corpus": corpus_options,
+            "benchmarks": {},
+        }
+
+        use_test_db = any(name in benchmarks.DATASTORE_BENCHMARKS for name in names)
+        if use_test_db:
+            setup_test_environment()
+            old_name = connection.creation.create_test_db(verbosity=0)
+
+        try:
+            for name in names:
+                results["benchmarks"][name] = benchmarks.BENCHMARKS[name](corpus, options["repeat"])
+        finally:
+            if use_test_db:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output + "\n")
@@ -1,8 +1,36 @@
+import array
+import hashlib
 import itertools
+import logging
+import uuid
+from collections import Counter, defaultdict, namedtuple
 
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models
+from django.utils.encoding import smart_str
+from google.appengine.ext.deferred import defer
 
-from base_models import AbstractIndex, AbstractIndexRecord
+try:
+    from djangae.fields import ListField
+except ImportError:
+    from djangotoolbox.fields import ListField
+
+from base_models import (
+    AbstractIndex, AbstractIndexRecord, BaseIndex, COMPACT_COUNT_KEY_RANGE, QUEUE_FOR_INDEXING
+)
+from instrumentation import index_completed, operation, phase, search_completed
+
+# How long (in seconds) the ranked results behind a search cursor are kept, and how many results are kept
+CURSOR_TIMEOUT = getattr(settings, "SEARCH_CURSOR_TIMEOUT", 60 * 10)
+CURSOR_MAX_RESULTS = getattr(settings, "SEARCH_CURSOR_MAX_RESULTS", 1000)
+
+# Index models on save and delete with CompactIndex rather than Index
+USE_COMPACT_INDEX = getattr(settings, "SEARCH_USE_COMPACT_INDEX", False)
+
+# The most terms kept in one CompactIndexRecord, larger fields are split over several records. Every term adds
+# entries to the built in and composite indexes, and the datastore allows 20000 index entries per entity.
+COMPACT_RECORD_MAX_TERMS = getattr(settings, "SEARCH_COMPACT_RECORD_MAX_TERMS", 2000)
 
 
 """
@@ -28,7 +56,213 @@ class IndexRecord(AbstractIndexRecord):
     OBJECT_ID_FIELD = 'instance_pk'
 
 
-class Index(AbstractIndex):
+def stable_id(value):
+    """ A 63 bit integer standing in for a string, the same in every process. """
+    return int(hashlib.md5(smart_str(value)).hexdigest()[:16], 16) >> 1
+
+
+def term_count_key(term_id):
+    """ The GlobalOccuranceCount key for a term in a CompactIndex. Tokenizing always splits "#" off into its own
+        token, so no term indexed by Index can start with "#" followed by a digit.
+    """
+    return "#%d" % term_id
+
+
+class CompactIndexRecord(models.Model):
+    """ Every term in one field of one instance, or one chunk of them for fields with more than
+        COMPACT_RECORD_MAX_TERMS terms.
+
+        Rather than repeating the term, table and field names in a record per term, the db table and field are
+        stored once as stable_ids and the terms as a list of stable_ids. Only terms is ever filtered on, so the
+        occurances of each term are packed into an unindexed string of comma separated counts, see term_occurances.
+    """
+    id = models.CharField(max_length=64, primary_key=True)
+    instance_db_table = models.BigIntegerField()
+    instance_pk = models.PositiveIntegerField(default=0)
+    field = models.BigIntegerField()
+    terms = ListField(models.BigIntegerField())
+    occurances = models.TextField()
+
+    OBJECT_ID_FIELD = 'instance_pk'
+
+    @staticmethod
+    def make_id(obj, field, chunk=0):
+        return "%d:%d:%d:%d" % (stable_id(obj._meta.db_table), obj.pk, stable_id(field), chunk)
+
+    @staticmethod
+    def pack_occurances(occurances):
+        return ",".join(str(x) for x in occurances)
+
+    def term_occurances(self):
+        """ A list of (term_id, occurances) for every term in the record. """
+        return zip(self.terms, [int(x) for x in self.occurances.split(",")])
+
+    @classmethod
+    def count_occurances(cls, term):
+        term_id = int(term[1:])
+        return sum(
+            dict(record.term_occurances())[term_id]
+            for record in cls.objects.filter(terms__contains=term_id)
+        )
+
+    @classmethod
+    def count_key_ranges(cls):
+        return [COMPACT_COUNT_KEY_RANGE]
+
+
+class CompactMatch(namedtuple("CompactMatch", "record count_key")):
+    """ One matched term of a CompactIndexRecord, ranked like an IndexRecord holding only that term. """
+    OBJECT_ID_FIELD = 'instance_pk'
+
+    @property
+    def instance_pk(self):
+        return self.record.instance_pk
+
+
+class ModelSearchMixin(object):
+    """ Searching the django model instances indexed by an index, with page numbers or cursors. """
+
+    def _get_model_filters(self, model_class):
+        """ Filters restricting index records to those of model_class. """
+        raise NotImplementedError("Subclasses should implement this.")
+
+    def search(self, model_class, search_string, per_page=50, current_page=1, total_pages=10, **filters):
+        with operation(search_completed, self.__class__, "search", model=model_class._meta.db_table,
+                       current_page=current_page) as op:
+            with op.phase("parse_terms"):
+                terms = list(itertools.chain(*self.parse_terms(search_string).values()))
+                terms = self._fit_terms_to_policy(model_class, terms)
+            op.set("terms", len(terms))
+
+            obj_weights = self._get_matches(terms, extra_filters=self._get_model_filters(model_class),
+                                            split_unmatched=self._uses_common_threshold(model_class))
+            op.set("candidates", len(obj_weights))
+
+            with op.phase("ranking"):
+                matches_in_order = self._get_result_order(obj_weights, per_page, current_page, total_pages)
+
+            with op.phase("hydrate"):
+                instance_pks = [x.instance_pk for x in matches_in_order]
+
+                queryset = model_class.objects.all()
+
+                if filters:
+                    queryset = queryset.filter(**filters)
+
+                results = queryset.filter(pk__in=instance_pks)
+                results_by_pk = {x.pk: x for x in results}
+
+                # remove duplicates, maintain the matches_in_order, exclude items that are excluded by the filters
+                seen = set()
+
+                sorted_instances = []
+
+                for result in matches_in_order:
+                    if result.instance_pk not in seen:
+                        if result.instance_pk in results_by_pk:
+                            sorted_instances.append(results_by_pk[result.instance_pk])
+                            seen.add(result.instance_pk)
+
+            op.set("results", len(sorted_instances))
+            return sorted_instances
+
+    def search_with_cursor(self, model_class, search_string, cursor=None, per_page=50, **filters):
+        """ Like search, but pages through the results with cursors rather than page numbers.
+
+            The first call ranks the results once and caches the ordered instance pks, later calls with the
+            returned cursor just take the next slice of them, so every page costs the same and results don't
+            move around between pages. If the cached pks have expired they are ranked again. Cursors carry a hash
+            of the model, search string and filters they were returned for, and a cursor returned by a different
+            search is ignored, so the first page of this search is returned instead.
+
+            Returns a tuple of (instances, next_cursor), next_cursor is None on the last page.
+        """
+        with operation(search_completed, self.__class__, "search_with_cursor", model=model_class._meta.db_table,
+                       cursor=cursor) as op:
+            key, search_hash, offset = self._parse_cursor(cursor)
+            current_hash = self._search_hash(model_class, search_string, filters)
+
+            if key and search_hash != current_hash:
+                # The cursor belongs to another search, leave its results alone and start from the top
+                logging.warning("Search cursor %r doesn't match search %r, ignoring it", cursor, search_string)
+                key, offset = None, 0
+
+            instance_pks = None
+            if key:
+                with op.phase("cursor_cache"):
+                    cached = cache.get(self._cursor_cache_key(key))
+                op.incr("cache_misses" if cached is None else "cache_hits")
+                if cached is not None:
+                    instance_pks = self._unpack_pks(cached["pks"])
+
+            key = key or uuid.uuid4().hex
+
+            if instance_pks is None:
+                with op.phase("parse_terms"):
+                    terms = list(itertools.chain(*self.parse_terms(search_string).values()))
+                    terms = self._fit_terms_to_policy(model_class, terms)
+                op.set("terms", len(terms))
+
+                obj_weights = self._get_matches(terms, extra_filters=self._get_model_filters(model_class),
+                                                split_unmatched=self._uses_common_threshold(model_class))
+                op.set("candidates", len(obj_weights))
+
+                with op.phase("ranking"):
+                    instance_pks = self._get_ranked_ids(obj_weights, CURSOR_MAX_RESULTS)
+                self._cache_pks(key, instance_pks)
+
+            with op.phase("hydrate"):
+                instances = []
+                while len(instances) < per_page and offset < len(instance_pks):
+                    page_pks = instance_pks[offset:offset + per_page - len(instances)]
+                    offset += len(page_pks)
+
+                    queryset = model_class.objects.all()
+                    if filters:
+                        queryset = queryset.filter(**filters)
+
+                    results_by_pk = {x.pk: x for x in queryset.filter(pk__in=page_pks)}
+                    instances.extend(results_by_pk[pk] for pk in page_pks if pk in results_by_pk)
+
+            op.set("results", len(instances))
+            next_cursor = "%s:%s:%s" % (key, current_hash, offset) if offset < len(instance_pks) else None
+            return instances, next_cursor
+
+    @staticmethod
+    def _parse_cursor(cursor):
+        """ Split a cursor into the cache key of its ranked pks, the hash of its search (see _search_hash) and
+            the offset of the next page.
+        """
+        if not cursor:
+            return None, None, 0
+        try:
+            key, search_hash, offset = cursor.split(":")
+            return key, search_hash, int(offset)
+        except ValueError:
+            raise ValueError("Invalid search cursor %r" % cursor)
+
+    @staticmethod
+    def _search_hash(model_class, search_string, filters):
+        """ A short hash identifying a search, so cursors can't be used with a different one. """
+        search = (model_class._meta.db_table, search_string, sorted(filters.items()))
+        return hashlib.md5(smart_str(repr(search))).hexdigest()[:8]
+
+    @staticmethod
+    def _cursor_cache_key(key):
+        return "simple_search_cursor:%s" % key
+
+    def _cache_pks(self, key, instance_pks):
+        # Pack the pks into an array, 1000 results take 8KB rather than a pickled list of ints
+        cache.set(self._cursor_cache_key(key), {"pks": array.array('L', instance_pks).tostring()}, CURSOR_TIMEOUT)
+
+    @staticmethod
+    def _unpack_pks(packed):
+        instance_pks = array.array('L')
+        instance_pks.fromstring(packed)
+        return instance_pks.tolist()
+
+
+class Index(ModelSearchMixin, AbstractIndex):
     indexrecord_class = IndexRecord
 
     def get_or_create_record(self, obj, field, iexact, occurances):
@@ -47,37 +281,134 @@ class Index(AbstractIndex):
         return self.indexrecord_class.objects.filter(
             instance_db_table=instance._meta.db_table, instance_pk=instance.pk).all()
 
-    def search(self, model_class, search_string, per_page=50, current_page=1, total_pages=10, **filters):
-        terms = list(itertools.chain(*self.parse_terms(search_string).values()))
+    def _get_model_filters(self, model_class):
+        return {'instance_db_table': model_class._meta.db_table}
+
+
+class CompactIndex(ModelSearchMixin, BaseIndex):
+    """ An Index storing a CompactIndexRecord per field (or chunk of a large field) of each instance,
+        see CompactIndexRecord.
+
+        Fields are indexed as a whole (one deferred task per field rather than per term), and the
+        GlobalOccuranceCounts of its terms are kept under term_count_keys.
+    """
+    indexrecord_class = CompactIndexRecord
+
+    def _get_model_filters(self, model_class):
+        return {'instance_db_table': stable_id(model_class._meta.db_table)}
+
+    def _count_key(self, term):
+        return term_count_key(stable_id(term))
+
+    def _get_records(self, instance):
+        return self.indexrecord_class.objects.filter(
+            instance_db_table=stable_id(instance._meta.db_table), instance_pk=instance.pk).all()
+
+    def unindex(self, obj):
+        """ Unindex an object by deleting its records and subtracting their terms from the counts. """
+        with operation(index_completed, self.__class__, "unindex") as op:
+            with op.phase("fetch_records"):
+                records = list(self._get_records(obj))
+            op.incr("records_deleted", len(records))
+
+            deltas = defaultdict(int)
+            with op.phase("delete_records"):
+                for record in records:
+                    for term_id, occurances in record.term_occurances():
+                        deltas[term_count_key(term_id)] -= occurances
+                    record.delete()
+
+            with op.phase("write_counts"):
+                self._change_counts(deltas)
+
+    def _do_index(self, obj, fields_to_index, defer_index=True):
+        logging.info("[SIMPLE_SEARCH] Indexing object %s, spawning _index_field tasks" % obj)
+        for field in fields_to_index:
+            if defer_index:
+                with phase("defer_fields"):
+                    defer(self._index_field, obj, field, _queue=QUEUE_FOR_INDEXING)
+            else:
+                self._index_field(obj, field)
+
+    def _index_field(self, obj, field):
+        with operation(index_completed, self.__class__, "index_field") as op:
+            with op.phase("get_field_data"):
+                texts = self.get_field_data(field, obj)
+
+            policy = self.get_ngram_policy(obj, field)
+            term_counts = Counter()
+            with op.phase("generate_terms"):
+                for text in texts:
+                    term_counts.update(self._generate_terms(text, policy))
+            op.incr("terms", len(term_counts))
+
+            with op.phase("write_record"):
+                self._save_record(obj, field, term_counts)
+
+    def _save_record(self, obj, field, term_counts):
+        """ Write the records for a field of obj from a dict of {term: occurances}, COMPACT_RECORD_MAX_TERMS terms
+            at a time, and add them to the counts.
+        """
+        term_ids = [(stable_id(term), occurances) for term, occurances in term_counts.items()]
+        for chunk, i in enumerate(xrange(0, len(term_ids), COMPACT_RECORD_MAX_TERMS)):
+            chunk_ids = term_ids[i:i + COMPACT_RECORD_MAX_TERMS]
+            CompactIndexRecord(
+                id=CompactIndexRecord.make_id(obj, field, chunk),
+                instance_db_table=stable_id(obj._meta.db_table),
+                instance_pk=obj.pk,
+                field=stable_id(field),
+                terms=[term_id for term_id, occurances in chunk_ids],
+                occurances=CompactIndexRecord.pack_occurances(occurances for term_id, occurances in chunk_ids),
+            ).save()
+
+        if term_ids:
+            self._change_counts(dict((term_count_key(term_id), occurances) for term_id, occurances in term_ids))
+
+    def _get_term_filters(self, terms):
+        return {'terms__overlap': list(set(stable_id(term) for term in terms))}
+
+    def _get_record_counts(self, record, count_keys):
+        counts = [(term_count_key(term_id), occurances) for term_id, occurances in record.term_occurances()]
+        return [(count_key, occurances) for count_key, occurances in counts if count_key in count_keys]
 
-        obj_weights = self._get_matches(terms, extra_filters={'instance_db_table': model_class._meta.db_table})
-        matches_in_order = self._get_result_order(obj_weights, per_page, current_page, total_pages)
+    def _get_term_match(self, record, count_key):
+        return CompactMatch(record, count_key)
 
-        instance_pks = [x.instance_pk for x in matches_in_order]
 
-        queryset = model_class.objects.all()
+def migrate_to_compact_index(model_class, batch_size=100, last_pk=None, delete_records=False):
+    """ Copy the IndexRecords of model_class's instances into CompactIndexRecords, batch_size instances at a time,
+        deferring itself to carry on after last_pk.
 
-        if filters:
-            queryset = queryset.filter(**filters)
+        The compact records are built from the existing IndexRecords, so nothing is tokenized again. Migrating
+        an instance twice is harmless. With delete_records the IndexRecords are unindexed once copied, which also
+        removes their GlobalOccuranceCounts.
+    """
+    instances = model_class.objects.order_by("pk")
+    if last_pk is not None:
+        instances = instances.filter(pk__gt=last_pk)
+    instances = list(instances[:batch_size])
 
-        results = queryset.filter(pk__in=instance_pks)
-        results_by_pk = {x.pk: x for x in results}
+    for instance in instances:
+        term_counts_by_field = defaultdict(Counter)
+        for record in index._get_records(instance):
+            term_counts_by_field[record.field][record.iexact] += record.occurances
 
-        # remove duplicates, maintain the matches_in_order, exclude items that are excluded by the filters
-        seen = set()
+        compact_index.unindex(instance)
+        for field, term_counts in term_counts_by_field.items():
+            compact_index._save_record(instance, field, term_counts)
 
-        sorted_instances = []
+        if delete_records:
+            index.unindex(instance)
 
-        for result in matches_in_order:
-            if result.instance_pk not in seen:
-                if result.instance_pk in results_by_pk:
-                    sorted_instances.append(results_by_pk[result.instance_pk])
-                    seen.add(result.instance_pk)
+    logging.info("[SIMPLE_SEARCH] Migrated %s %s instances to the compact index", len(instances), model_class)
 
-        return sorted_instances
+    if len(instances) == batch_size:
+        defer(migrate_to_compact_index, model_class, batch_size, instances[-1].pk, delete_records,
+              _queue=QUEUE_FOR_INDEXING)
 
 
 index = Index()
+compact_index = CompactIndex()
 
 from django.dispatch import receiver
 from django.db.models.signals import post_save, pre_delete
@@ -88,10 +419,12 @@ def post_save_index(sender, instance, created, raw, *args, **kwargs):
     if getattr(instance, "Search", None):
         fields_to_index = getattr(instance.Search, "fields", [])
         if fields_to_index:
-            index.index(instance, fields_to_index, defer_index=not raw)  # Don't defer if we are loading from a fixture
+            signal_index = compact_index if USE_COMPACT_INDEX else index
+            signal_index.index(instance, fields_to_index, defer_index=not raw)  # Don't defer if we are loading from a fixture
 
 
 @receiver(pre_delete)
 def pre_delete_unindex(sender, instance, using, *args, **kwarg):
     if getattr(instance, "Search", None):
-        index.unindex(instance)
+        signal_index = compact_index if USE_COMPACT_INDEX else index
+        signal_index.unindex(instance)
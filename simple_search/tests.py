@@ -13,12 +13,22 @@ try:
 except ImportError:
     from djangotoolbox.fields import ListField
 
+from django.core.cache import cache
 from django.db import models
 from django.test import TestCase
+from google.appengine.ext import db
 #from potatobase.testbase import PotatoTestCase
 
-from .base_models import AbstractIndexRecord, AbstractIndex, GlobalOccuranceCount
-from .models import IndexRecord, index
+from .base_models import (
+    AbstractIndexRecord, AbstractIndex, FOLD_LEASE_KEY, GlobalOccuranceCount, GlobalOccuranceDelta, LOG_COUNTS,
+    REGEX_TOKENIZER, _fold_deltas, apply_count_deltas, fold_count_deltas, recompute_global_counts, regex_tokenize,
+    start_fold_count_deltas
+)
+from .models import (
+    CompactIndexRecord, Index, IndexRecord, compact_index, index, migrate_to_compact_index, stable_id, term_count_key
+)
+from . import instrumentation
+from .transactions import retry_transaction, TRANSACTION_ATTEMPTS
 
 
 class MockRelatedManager(object):
@@ -50,6 +60,11 @@ class TestIndex(AbstractIndex):
     indexrecord_class = TestIndexRecord
 test_index = TestIndex()
 
+
+class CountLogIndex(Index):
+    count_mode = LOG_COUNTS
+count_log_index = CountLogIndex()
+
 class SearchTests(TestCase):
     def test_field_indexing(self):
         instance1 = SampleModel.objects.create(
@@ -170,6 +185,423 @@ class SearchTests(TestCase):
 
 
 
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        self.operations = []
+        instrumentation.search_completed.connect(self.receive)
+        instrumentation.index_completed.connect(self.receive)
+
+    def tearDown(self):
+        instrumentation.search_completed.disconnect(self.receive)
+        instrumentation.index_completed.disconnect(self.receive)
+
+    def receive(self, sender, operation, **kwargs):
+        self.operations.append(operation)
+
+    def test_index_and_search_operations(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        index.index(instance1, ["field1"], defer_index=False)
+
+        # reindex, unindex and _index_term are folded into the outer index operation
+        self.assertEqual(["index"], [x.name for x in self.operations])
+        self.assertEqual(3, self.operations[0].counts["terms"])
+        self.assertEqual(3, self.operations[0].counts["terms_written"])
+        self.assertTrue("generate_terms" in self.operations[0].timings)
+
+        self.assertEqual([instance1], index.search(SampleModel, "banana"))
+        search = self.operations[-1]
+        self.assertEqual("search", search.name)
+        self.assertEqual(1, search.counts["results"])
+        self.assertEqual(1, search.counts["index_records"])
+        for phase in ["total", "parse_terms", "global_counts", "index_records", "ranking", "hydrate"]:
+            self.assertTrue(phase in search.timings, phase)
+
+    def test_no_listeners(self):
+        instrumentation.search_completed.disconnect(self.receive)
+        index.search(SampleModel, "banana")
+        self.assertEqual([], self.operations)
+        self.assertTrue(instrumentation.current() is instrumentation.NULL_OPERATION)
+
+    def test_aggregator(self):
+        aggregator = instrumentation.Aggregator()
+        for i in xrange(1, 101):
+            operation = instrumentation.Operation("search")
+            operation.timings["total"] = i
+            operation.set("results", 1)
+            aggregator.receive(None, operation)
+
+        self.assertEqual({"samples": 100, "p50": 50, "p90": 90, "p99": 99}, aggregator.percentiles("search", "time.total"))
+        self.assertEqual(1, aggregator.summary()["search"]["results"]["p50"])
+        self.assertEqual(None, aggregator.percentiles("index", "time.total"))
+
+
+@mock.patch('simple_search.transactions.time.sleep')
+class TransactionRetryTests(TestCase):
+    def test_retry_transaction(self, sleep):
+        func = mock.Mock(side_effect=[db.TransactionFailedError(), db.TransactionFailedError(), "done"])
+        self.assertEqual("done", retry_transaction(func, 1, a=2))
+        self.assertEqual(3, func.call_count)
+        self.assertEqual(2, sleep.call_count)
+
+    def test_retry_transaction_is_bounded(self, sleep):
+        func = mock.Mock(side_effect=db.TransactionFailedError())
+        self.assertRaises(db.TransactionFailedError, retry_transaction, func)
+        self.assertEqual(TRANSACTION_ATTEMPTS, func.call_count)
+        for args, kwargs in sleep.call_args_list:
+            self.assertTrue(0 <= args[0] <= 1.0)
+
+    def test_unindex_defers_failed_count_changes(self, sleep):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        index.index(instance1, ["field1"], defer_index=False)
+        self.assertEqual(3, IndexRecord.objects.count())
+
+        with mock.patch('simple_search.base_models.retry_transaction', side_effect=db.TransactionFailedError()):
+            with mock.patch('simple_search.base_models.defer') as defer:
+                index.unindex(instance1)
+
+        # The records are gone, and the count changes are handed off in a single batch
+        self.assertEqual(0, IndexRecord.objects.count())
+        self.assertEqual(1, defer.call_count)
+        self.assertEqual((apply_count_deltas, {"banana": -1, "appl": -1, "banana appl": -1}), defer.call_args[0])
+
+        apply_count_deltas(defer.call_args[0][1])
+        self.assertEqual(0, GlobalOccuranceCount.objects.count())
+
+    def test_apply_count_deltas(self, sleep):
+        apply_count_deltas({"banana": 2, "appl": 1})
+        self.assertEqual(2, GlobalOccuranceCount.objects.get(pk="banana").count)
+
+        apply_count_deltas({"banana": -1, "appl": -1})
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="banana").count)
+        self.assertRaises(GlobalOccuranceCount.DoesNotExist, GlobalOccuranceCount.objects.get, pk="appl")
+
+
+class CountLogTests(TestCase):
+    def test_index_and_fold(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        instance2 = SampleModel.objects.create(field1="banana")
+        count_log_index.index(instance1, ["field1"], defer_index=False)
+        count_log_index.index(instance2, ["field1"], defer_index=False)
+
+        self.assertEqual(4, IndexRecord.objects.count())
+        self.assertEqual(0, GlobalOccuranceCount.objects.count())
+        self.assertEqual(4, GlobalOccuranceDelta.objects.count())
+
+        # Missing counts are estimated until the deltas are folded in
+        self.assertItemsEqual([instance1, instance2], count_log_index.search(SampleModel, "banana"))
+
+        fold_count_deltas()
+        self.assertEqual(0, GlobalOccuranceDelta.objects.count())
+        self.assertEqual(2, GlobalOccuranceCount.objects.get(pk="banana").count)
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="appl").count)
+
+        count_log_index.unindex(instance1)
+        self.assertEqual(1, IndexRecord.objects.count())
+        self.assertEqual(2, GlobalOccuranceCount.objects.get(pk="banana").count)
+
+        fold_count_deltas()
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="banana").count)
+        self.assertRaises(GlobalOccuranceCount.DoesNotExist, GlobalOccuranceCount.objects.get, pk="appl")
+
+    def test_fold_is_batched(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        count_log_index.index(instance1, ["field1"], defer_index=False)
+
+        with mock.patch('simple_search.base_models.defer') as defer:
+            fold_count_deltas(batch_size=2)
+        self.assertEqual(1, GlobalOccuranceDelta.objects.count())
+        self.assertEqual((fold_count_deltas, 2), defer.call_args[0])
+
+    def test_fold_stops_without_progress(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        count_log_index.index(instance1, ["field1"], defer_index=False)
+        cache.set(FOLD_LEASE_KEY, True)
+
+        with mock.patch('simple_search.base_models.retry_transaction', side_effect=db.TransactionFailedError()):
+            with mock.patch('simple_search.base_models.defer') as defer:
+                fold_count_deltas(batch_size=2)
+
+        # Nothing could be folded, so the chain stops and leaves the deltas for the next cron run
+        self.assertFalse(defer.called)
+        self.assertEqual(3, GlobalOccuranceDelta.objects.count())
+        self.assertEqual(None, cache.get(FOLD_LEASE_KEY))
+
+    def test_fold_skips_deleted_deltas(self):
+        delta1 = GlobalOccuranceDelta.objects.create(term="banana", delta=1)
+        delta2 = GlobalOccuranceDelta.objects.create(term="banana", delta=1)
+        _fold_deltas("banana", [delta1.pk, delta2.pk])
+        self.assertEqual(2, GlobalOccuranceCount.objects.get(pk="banana").count)
+
+        # A stale query can hand the same deltas over again, they mustn't be counted twice
+        delta3 = GlobalOccuranceDelta.objects.create(term="banana", delta=1)
+        _fold_deltas("banana", [delta1.pk, delta2.pk, delta3.pk])
+        self.assertEqual(3, GlobalOccuranceCount.objects.get(pk="banana").count)
+        self.assertEqual(0, GlobalOccuranceDelta.objects.count())
+
+    def test_fold_lease(self):
+        cache.delete(FOLD_LEASE_KEY)
+        with mock.patch('simple_search.base_models.defer') as defer:
+            self.assertTrue(start_fold_count_deltas())
+            self.assertFalse(start_fold_count_deltas())
+        self.assertEqual(1, defer.call_count)
+
+        # Finishing the chain releases the lease
+        fold_count_deltas()
+        with mock.patch('simple_search.base_models.defer') as defer:
+            self.assertTrue(start_fold_count_deltas())
+        self.assertEqual(1, defer.call_count)
+        cache.delete(FOLD_LEASE_KEY)
+
+    def test_recompute_global_counts(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        index.index(instance1, ["field1"], defer_index=False)
+        GlobalOccuranceCount.objects.filter(pk="banana").update(count=10)
+        GlobalOccuranceDelta.objects.create(term="banana", delta=1)
+
+        recompute_global_counts(IndexRecord)
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="banana").count)
+        self.assertEqual(0, GlobalOccuranceDelta.objects.count())
+
+    def test_recompute_only_touches_own_counts(self):
+        instance1 = SampleModel.objects.create(field1="banana apple")
+        index.index(instance1, ["field1"], defer_index=False)
+        compact_index.index(instance1, ["field1"], defer_index=False)
+        compact_key = term_count_key(stable_id("banana"))
+        GlobalOccuranceCount.objects.filter(pk__in=["banana", compact_key]).update(count=10)
+
+        recompute_global_counts(IndexRecord)
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="banana").count)
+        self.assertEqual(10, GlobalOccuranceCount.objects.get(pk=compact_key).count)
+
+        recompute_global_counts(CompactIndexRecord)
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk=compact_key).count)
+        self.assertEqual(1, GlobalOccuranceCount.objects.get(pk="banana").count)
+
+
+class CursorSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.instances = []
+        for i in xrange(5):
+            instance = SampleModel.objects.create(field1="banana", field2=str(i % 2))
+            index.index(instance, ["field1"], defer_index=False)
+            self.instances.append(instance)
+
+    def test_paging(self):
+        page1, cursor = index.search_with_cursor(SampleModel, "banana", per_page=2)
+        self.assertEqual(2, len(page1))
+
+        # Later pages come from the cache, without searching the index again
+        with mock.patch('simple_search.models.Index._get_matches') as get_matches:
+            page2, cursor = index.search_with_cursor(SampleModel, "banana", cursor=cursor, per_page=2)
+            page3, cursor = index.search_with_cursor(SampleModel, "banana", cursor=cursor, per_page=2)
+        self.assertFalse(get_matches.called)
+
+        self.assertEqual(None, cursor)
+        self.assertEqual([2, 1], [len(page2), len(page3)])
+        self.assertItemsEqual(self.instances, page1 + page2 + page3)
+
+    def test_expired_cursor(self):
+        page1, cursor = index.search_with_cursor(SampleModel, "banana", per_page=3)
+        cache.clear()
+        page2, cursor = index.search_with_cursor(SampleModel, "banana", cursor=cursor, per_page=3)
+
+        self.assertEqual(None, cursor)
+        self.assertItemsEqual(self.instances, page1 + page2)
+
+    def test_filters_fill_the_page(self):
+        page1, cursor = index.search_with_cursor(SampleModel, "banana", per_page=2, field2="0")
+        page2, cursor = index.search_with_cursor(SampleModel, "banana", cursor=cursor, per_page=2, field2="0")
+
+        self.assertEqual(2, len(page1))
+        self.assertItemsEqual(self.instances[::2], page1 + page2)
+
+    def test_cursor_from_another_search(self):
+        other = SampleModel.objects.create(field1="cherry")
+        index.index(other, ["field1"], defer_index=False)
+        page1, banana_cursor = index.search_with_cursor(SampleModel, "banana", per_page=2)
+
+        # The first page of the cherry search, without overwriting the banana results
+        page, cursor = index.search_with_cursor(SampleModel, "cherry", cursor=banana_cursor, per_page=2)
+        self.assertEqual([other], page)
+        self.assertEqual(None, cursor)
+
+        with mock.patch('simple_search.models.Index._get_matches') as get_matches:
+            page2, cursor = index.search_with_cursor(SampleModel, "banana", cursor=banana_cursor, per_page=3)
+        self.assertFalse(get_matches.called)
+        self.assertItemsEqual(self.instances, page1 + page2)
+
+    def test_expired_cursor_from_another_search(self):
+        page1, cursor = index.search_with_cursor(SampleModel, "banana", per_page=2)
+        cache.clear()
+
+        # Different filters make a different search, so the stale offset isn't applied
+        page, cursor = index.search_with_cursor(SampleModel, "banana", cursor=cursor, per_page=3, field2="0")
+        self.assertItemsEqual(self.instances[::2], page)
+        self.assertEqual(None, cursor)
+
+    def test_invalid_cursor(self):
+        self.assertRaises(ValueError, index.search_with_cursor, SampleModel, "banana", cursor="banana")
+
+
+class CompactIndexTests(TestCase):
+    def test_basic_searching(self):
+        instance1 = SampleModel.objects.create(field1="Banana", field2="Apple")
+        instance2 = SampleModel.objects.create(field1="banana banana", field2="Cherry")
+
+        compact_index.index(instance1, ["field1", "field2"], defer_index=False)
+        compact_index.index(instance2, ["field1", "field2"], defer_index=False)
+
+        # One record per field, rather than per term
+        self.assertEqual(4, CompactIndexRecord.objects.count())
+        record = CompactIndexRecord.objects.get(pk=CompactIndexRecord.make_id(instance2, "field1"))
+        self.assertItemsEqual([(stable_id("banana"), 2), (stable_id("banana banana"), 1)], record.term_occurances())
+        self.assertEqual(3, GlobalOccuranceCount.objects.get(pk=term_count_key(stable_id("banana"))).count)
+
+        self.assertItemsEqual([instance1, instance2], compact_index.search(SampleModel, "banana"))
+        self.assertEqual([instance2], compact_index.search(SampleModel, "cherry"))
+
+        compact_index.unindex(instance1)
+        self.assertEqual(2, CompactIndexRecord.objects.count())
+        self.assertEqual(2, GlobalOccuranceCount.objects.get(pk=term_count_key(stable_id("banana"))).count)
+        self.assertEqual([instance2], compact_index.search(SampleModel, "banana"))
+        self.assertEqual(2, CompactIndexRecord.count_occurances(term_count_key(stable_id("banana"))))
+
+    def test_large_fields_are_chunked(self):
+        instance1 = SampleModel.objects.create(field1="bananas apples cherries")
+        with mock.patch('simple_search.models.COMPACT_RECORD_MAX_TERMS', 2):
+            compact_index.index(instance1, ["field1"], defer_index=False)
+
+        # 6 terms, so 3 records of 2
+        self.assertEqual(3, CompactIndexRecord.objects.count())
+        self.assertTrue(CompactIndexRecord.objects.filter(pk=CompactIndexRecord.make_id(instance1, "field1", 2)).exists())
+        self.assertEqual([instance1], compact_index.search(SampleModel, '"bananas apples cherries"'))
+        self.assertEqual([instance1], compact_index.search(SampleModel, "cherries"))
+
+        compact_index.unindex(instance1)
+        self.assertEqual(0, CompactIndexRecord.objects.count())
+        self.assertEqual(0, GlobalOccuranceCount.objects.count())
+
+    def test_ranking_matches_index(self):
+        # banana is common, apple is rare, so the document with both ranks by apple rather than an average
+        both = SampleModel.objects.create(field1="banana apple")
+        cherries = SampleModel.objects.create(field1="cherry cherry")
+        bananas = [SampleModel.objects.create(field1="banana") for i in xrange(5)]
+        for instance in [both, cherries] + bananas:
+            index.index(instance, ["field1"], defer_index=False)
+            compact_index.index(instance, ["field1"], defer_index=False)
+
+        results = index.search(SampleModel, "banana apple cherry")
+        compact_results = compact_index.search(SampleModel, "banana apple cherry")
+        self.assertEqual([both, cherries], results[:2])
+        self.assertEqual(results[:2], compact_results[:2])
+        self.assertItemsEqual(results, compact_results)
+
+    def test_migrate_to_compact_index(self):
+        instance1 = SampleModel.objects.create(field1="banana apple", field2="cherry")
+        instance2 = SampleModel.objects.create(field1="banana")
+        index.index(instance1, ["field1", "field2"], defer_index=False)
+        index.index(instance2, ["field1", "field2"], defer_index=False)
+
+        with mock.patch('simple_search.models.defer') as defer:
+            migrate_to_compact_index(SampleModel, batch_size=1)
+        self.assertEqual((migrate_to_compact_index, SampleModel, 1, instance1.pk, False), defer.call_args[0])
+        migrate_to_compact_index(SampleModel, last_pk=instance1.pk)
+        migrate_to_compact_index(SampleModel)  # Running it again doesn't change anything
+
+        self.assertEqual(3, CompactIndexRecord.objects.count())
+        self.assertEqual(2, GlobalOccuranceCount.objects.get(pk=term_count_key(stable_id("banana"))).count)
+        self.assertItemsEqual(index.search(SampleModel, "banana apple cherry"), compact_index.search(SampleModel, "banana apple cherry"))
+
+        migrate_to_compact_index(SampleModel, delete_records=True)
+        self.assertEqual(0, IndexRecord.objects.count())
+        self.assertRaises(GlobalOccuranceCount.DoesNotExist, GlobalOccuranceCount.objects.get, pk="banana")
+        self.assertItemsEqual([instance1, instance2], compact_index.search(SampleModel, "banana"))
+
+
+class NgramPolicyTests(TestCase):
+    class Search:
+        fields = ["field1", "field2"]
+        ngrams = {"max_length": 2, "common_terms": ["new", "york"]}
+        field_ngrams = {"field2": {"phrase_boundaries": True}}
+
+    def test_get_ngram_policy(self):
+        with mock.patch.object(SampleModel, "Search", new=self.Search, create=True):
+            self.assertEqual(2, index.get_ngram_policy(SampleModel, "field1")["max_length"])
+            self.assertFalse(index.get_ngram_policy(SampleModel, "field1")["phrase_boundaries"])
+            self.assertTrue(index.get_ngram_policy(SampleModel, "field2")["phrase_boundaries"])
+        self.assertEqual(4, index.get_ngram_policy(SampleModel, "field1")["max_length"])
+
+    def test_generate_terms(self):
+        policy = index.get_ngram_policy({})
+        self.assertEqual(["banana", "banana appl", "appl"], index._generate_terms("bananas apples", policy))
+
+        policy["max_length"] = 1
+        self.assertEqual(["banana", "appl"], index._generate_terms("bananas apples", policy))
+
+        policy.update(max_length=2, phrase_boundaries=True)
+        self.assertEqual(["banana", "appl", "appl cherri", "cherri"], index._generate_terms("bananas. apples cherries", policy))
+
+        policy.update(phrase_boundaries=False, common_terms=["new", "york"])
+        self.assertEqual(["new", "york", "york kiwi", "kiwi"], index._generate_terms("New York kiwi", policy))
+
+    def test_common_threshold(self):
+        cache.clear()
+        GlobalOccuranceCount.objects.create(pk="new", count=10)
+        GlobalOccuranceCount.objects.create(pk="york", count=5)
+        policy = dict(index.get_ngram_policy({}), common_threshold=5)
+        self.assertEqual(["new", "york", "york kiwi", "kiwi"], index._generate_terms("New York kiwi", policy))
+
+    def test_common_threshold_changes_after_indexing(self):
+        class Search:
+            fields = ["field1"]
+            ngrams = {"common_threshold": 5}
+
+        cache.clear()
+        GlobalOccuranceCount.objects.create(pk="new", count=10)
+        GlobalOccuranceCount.objects.create(pk="york", count=10)
+        instance1 = SampleModel.objects.create(field1="new york")
+        with mock.patch.object(SampleModel, "Search", new=Search, create=True):
+            index.index(instance1, ["field1"], defer_index=False)
+            self.assertEqual(0, IndexRecord.objects.filter(iexact="new york").count())
+
+            # Once the words are no longer common the phrase isn't split, but is still found through its words
+            GlobalOccuranceCount.objects.filter(pk__in=["new", "york"]).update(count=1)
+            cache.clear()
+            self.assertEqual([u"new york"], index._fit_terms_to_policy(SampleModel, [u"new york"]))
+            self.assertEqual([instance1], index.search(SampleModel, '"new york"'))
+
+    def test_indexing_and_searching(self):
+        instance1 = SampleModel.objects.create(field1="bananas apples cherries plums, new york", field2="kiwi. oranges")
+        with mock.patch.object(SampleModel, "Search", new=self.Search, create=True):
+            index.index(instance1, ["field1", "field2"], defer_index=False)
+
+            self.assertEqual(0, IndexRecord.objects.filter(iexact="banana appl cherri").count())
+            self.assertEqual(0, IndexRecord.objects.filter(iexact="new york").count())
+            self.assertEqual(0, IndexRecord.objects.filter(iexact="kiwi orang").count())
+            self.assertEqual(1, IndexRecord.objects.filter(iexact="plum new").count())
+
+            # Long and common phrases are still found through the terms that were indexed
+            self.assertEqual([instance1], index.search(SampleModel, '"bananas apples cherries"'))
+            self.assertEqual([instance1], index.search(SampleModel, '"new york"'))
+
+    def test_field_policy_overrides(self):
+        class Search:
+            fields = ["field1", "field2"]
+            field_ngrams = {"field1": {"max_length": 2}, "field2": {"common_terms": ["new", "york"]}}
+
+        instance1 = SampleModel.objects.create(field1="apples cherries plums", field2="new york")
+        with mock.patch.object(SampleModel, "Search", new=Search, create=True):
+            index.index(instance1, ["field1", "field2"], defer_index=False)
+            self.assertEqual(0, IndexRecord.objects.filter(iexact="appl cherri plum").count())
+            self.assertEqual(0, IndexRecord.objects.filter(iexact="new york").count())
+
+            # Phrases are split to fit the field with the shortest n-grams, and by words common in any field
+            self.assertEqual([u"appl cherri", u"cherri plum"], index._fit_terms_to_policy(SampleModel, [u"appl cherri plum"]))
+            self.assertEqual([u"new", u"york"], index._fit_terms_to_policy(SampleModel, [u"new york"]))
+            self.assertEqual([instance1], index.search(SampleModel, '"apples cherries plums"'))
+            self.assertEqual([instance1], index.search(SampleModel, '"new york"'))
+
 class IndexTests(TestCase):
     def test_get_dict_data(self):
         """ Tests getting data from indexable objects, both plain (dict) ones and django instances. """
@@ -214,3 +646,19 @@ class CanonicalizeTests(TestCase):
         self.assertEqual(AbstractIndex.canonicalize("a it the development at if", remove_stopwords=False), ["a", "it", "the", "develop", "at", "if"])
         self.assertEqual(AbstractIndex.canonicalize("a it the development at if", do_stemming=False), ["development"])
         self.assertEqual(AbstractIndex.canonicalize("how__ do you like __dem__ apples",), ["how__", "like", "dem__", "appl"])
+
+    def test_regex_tokenizer(self):
+        class RegexIndex(AbstractIndex):
+            tokenizer = REGEX_TOKENIZER
+
+        self.assertEqual(regex_tokenize(u"isn't john's (dogs) cannot"), [u"is", u"n't", u"john", u"'s", u"(", u"dogs", u")", u"can", u"not"])
+        self.assertEqual(regex_tokenize(u'he said "no"'), [u"he", u"said", u"no"])
+
+        for text in ["a it the development at if", "how__ do you like __dem__ apples", "This:isn't a field", "Yo, what's up?"]:
+            self.assertEqual(AbstractIndex.canonicalize(text), RegexIndex.canonicalize(text))
+
+    def test_unknown_tokenizer(self):
+        class BrokenIndex(AbstractIndex):
+            tokenizer = "banana"
+
+        self.assertRaises(Exception, BrokenIndex.canonicalize, "test")
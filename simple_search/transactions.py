@@ -0,0 +1,41 @@
+""" Retrying datastore transactions with bounded, jittered exponential backoff. """
+
+import logging
+import random
+import time
+
+from django.conf import settings
+from google.appengine.ext import db
+
+from instrumentation import incr
+
+# Total number of attempts before giving up, and the backoff (in seconds) between them. The backoff doubles
+# after every attempt up to the maximum, and the actual sleep is a random amount between 0 and the backoff
+# so that colliding requests don't all retry at the same moment.
+TRANSACTION_ATTEMPTS = getattr(settings, "SEARCH_TRANSACTION_ATTEMPTS", 5)
+TRANSACTION_BACKOFF = getattr(settings, "SEARCH_TRANSACTION_BACKOFF", 0.05)
+TRANSACTION_MAX_BACKOFF = getattr(settings, "SEARCH_TRANSACTION_MAX_BACKOFF", 1.0)
+
+
+def backoff_delay(attempt, backoff=None, max_backoff=None):
+    """ Number of seconds to sleep after the given (zero based) failed attempt. """
+    backoff = TRANSACTION_BACKOFF if backoff is None else backoff
+    max_backoff = TRANSACTION_MAX_BACKOFF if max_backoff is None else max_backoff
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def retry_transaction(func, *args, **kwargs):
+    """ Call func(*args, **kwargs), retrying when it raises TransactionFailedError.
+
+        After TRANSACTION_ATTEMPTS attempts the last TransactionFailedError is re-raised, so callers should
+        catch it and fall back to something which doesn't block (e.g. deferring the work).
+    """
+    for attempt in xrange(TRANSACTION_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+        except db.TransactionFailedError:
+            if attempt == TRANSACTION_ATTEMPTS - 1:
+                raise
+            logging.warning("Transaction collision, retrying!")
+            incr("transaction_retries")
+            time.sleep(backoff_delay(attempt))
@@ -0,0 +1,5 @@
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('simple_search.views',
+    url(r'^fold-counts/$', 'fold_counts', name='simple_search_fold_counts'),
+)
@@ -1 +1,15 @@
-# Create your views here.
+from django.http import HttpResponse, HttpResponseForbidden
+
+from base_models import start_fold_count_deltas
+
+
+def fold_counts(request):
+    """ Cron handler which starts folding logged GlobalOccuranceDeltas into the GlobalOccuranceCounts,
+        unless the previous run is still going.
+    """
+    if not request.META.get("HTTP_X_APPENGINE_CRON"):
+        return HttpResponseForbidden()
+
+    if not start_fold_count_deltas():
+        return HttpResponse("Already running")
+    return HttpResponse("OK")